@@ -1,26 +1,29 @@
-import asyncio
 import logging
+import time
 from typing import Optional
 
 import click
-import coloredlogs
-import inquirer3
 
 from mac_internet_sharing.exceptions import AccessDeniedError, DeviceNotFoundError, NoDeviceConnectedError
 from mac_internet_sharing.mac_internet_sharing import SharingState, configure, get_apple_usb_ethernet_interfaces, \
     set_sharing_state, update_sharing_devices, verify_bridge
-from mac_internet_sharing.network_preference import INTERFACE_PREFERENCES, NetworkPreferencePlist, NetworkService, \
-    get_default_route_network_service, get_network_services_names
+from mac_internet_sharing.network_preference import NetworkService, get_default_route_network_service, \
+    get_network_preferences, get_network_services_names
 
 CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'], max_content_width=400)
 
 logging.getLogger('plumbum.local').disabled = True
-logging.getLogger('asyncio').disabled = True
-coloredlogs.install(level=logging.DEBUG)
+logging.basicConfig(level=logging.INFO, format='%(message)s')
 logger = logging.getLogger(__name__)
 
 
-async def plug_n_share_task(network_service_name: Optional[str], timeout: int = 1):
+def install_colored_logs() -> None:
+    """ Install colored logging, deferred so on/off/toggle don't pay for importing coloredlogs. """
+    import coloredlogs
+    coloredlogs.install(level=logging.DEBUG)
+
+
+def plug_n_share(network_service_name: Optional[str], timeout: int = 1):
     """ Continuously monitor for USB device changes and update SharingDevices. """
     network_service = get_network_service(network_service_name)
 
@@ -29,9 +32,9 @@ async def plug_n_share_task(network_service_name: Optional[str], timeout: int =
     logger.info(f'Connected devices: {set(prev_usb_devices.keys())}')
 
     # Configure sharing with the initially detected interfaces.
-    configure(network_service, list(prev_usb_devices.values()))
-    await set_sharing_state(SharingState.ON)
+    configure(network_service, list(prev_usb_devices.values()), start=True)
     while True:
+        get_apple_usb_ethernet_interfaces.cache_clear()
         current_usb_devices = get_apple_usb_ethernet_interfaces()
         if prev_usb_devices != current_usb_devices:
             if len(prev_usb_devices) > len(current_usb_devices):
@@ -40,21 +43,20 @@ async def plug_n_share_task(network_service_name: Optional[str], timeout: int =
                 logger.info(f'Adding devices {set(current_usb_devices.keys()) - set(prev_usb_devices.keys())}')
             prev_usb_devices = current_usb_devices
             interfaces = set(prev_usb_devices.values()).intersection(prev_usb_devices.values())
-            await update_sharing_devices(interfaces)
+            update_sharing_devices(interfaces)
             verify_bridge()
-        await asyncio.sleep(timeout)
+        time.sleep(timeout)
 
 
 def get_network_service(network_service_name: Optional[str]) -> NetworkService:
     """ Retrieve the network service by name or return the default if none provided. """
-    network_preferences = NetworkPreferencePlist(INTERFACE_PREFERENCES)
     if network_service_name is None:
         network_service = get_default_route_network_service()
         logger.info(
             f'Network service name was not provided; using default: {network_service.interface.user_defined_name}'
         )
     else:
-        network_service = network_preferences.network_services.get_by_user_defined_name(network_service_name)
+        network_service = get_network_preferences().network_services.get_by_user_defined_name(network_service_name)
         if network_service is None:
             raise ValueError(f'Network service "{network_service_name}" not found')
     return network_service
@@ -66,6 +68,8 @@ def get_selected_devices(devices: Optional[tuple[str]]) -> list[str]:
     if not usb_devices:
         raise NoDeviceConnectedError()
     if not devices:
+        import inquirer3
+
         udids = list(usb_devices.keys())
         questions = [
             inquirer3.Checkbox(
@@ -89,26 +93,30 @@ def cli() -> None:
 
 
 @cli.command('on')
-def cli_on() -> None:
+@click.option('-v', '--verify', is_flag=True, default=False, help='Wait for the bridge and show its status')
+def cli_on(verify: bool = False) -> None:
     """ Turn On Internet Sharing. """
-    asyncio.run(set_sharing_state(SharingState.ON))
+    set_sharing_state(SharingState.ON, verify=verify)
 
 
 @cli.command('off')
-def cli_off() -> None:
+@click.option('-v', '--verify', is_flag=True, default=False, help='Wait for the bridge and show its status')
+def cli_off(verify: bool = False) -> None:
     """ Turn OFF Internet Sharing. """
-    asyncio.run(set_sharing_state(SharingState.OFF))
+    set_sharing_state(SharingState.OFF, verify=verify)
 
 
 @cli.command('toggle')
-def cli_toggle() -> None:
+@click.option('-v', '--verify', is_flag=True, default=False, help='Wait for the bridge and show its status')
+def cli_toggle(verify: bool = False) -> None:
     """ Toggle Internet Sharing. """
-    asyncio.run(set_sharing_state(SharingState.TOGGLE))
+    set_sharing_state(SharingState.TOGGLE, verify=verify)
 
 
 @cli.command('status')
 def cli_status() -> None:
     """ Verify network bridge. """
+    install_colored_logs()
     verify_bridge()
 
 
@@ -120,11 +128,10 @@ def cli_configure(network_service_name: Optional[str] = None,
                   devices: Optional[tuple[str]] = None,
                   start: bool = False) -> None:
     """ Manually configure internet sharing with specified devices. """
+    install_colored_logs()
     network_service = get_network_service(network_service_name)
     selected_devices = get_selected_devices(devices)
-    configure(network_service, selected_devices)
-    if start:
-        asyncio.run(set_sharing_state(SharingState.ON))
+    configure(network_service, selected_devices, start=start)
 
 
 @cli.command('plug-n-share')
@@ -132,11 +139,12 @@ def cli_configure(network_service_name: Optional[str] = None,
 @click.option('-t', '--timeout', default=5, help='Polling interval in seconds.')
 def cli_plug_n_share(network_service_name: Optional[str], timeout: int = 5) -> None:
     """ Automatically detect USB devices and update internet sharing. """
+    install_colored_logs()
     try:
-        asyncio.run(plug_n_share_task(network_service_name, timeout))
+        plug_n_share(network_service_name, timeout)
     except KeyboardInterrupt:
         logger.info('Plug And Share stopped by user turning off internet sharing.')
-        asyncio.run(set_sharing_state(SharingState.OFF))
+        set_sharing_state(SharingState.OFF)
 
 
 def main():
@@ -6,6 +6,8 @@ from typing import Optional
 
 DHCPD_LEASES = Path('/var/db/dhcpd_leases')
 
+LEASE_BLOCK_PATTERN = re.compile(r"\{(.*?)\}", re.DOTALL)
+
 
 @dataclass
 class LeaseEntry:
@@ -18,14 +20,17 @@ class LeaseEntry:
     def from_entry(cls, entry: str) -> 'LeaseEntry':
         """ Parses a single lease entry block and returns a LeaseEntry object. """
 
-        name_pattern = re.search(r'name=(.*)', entry)
-        ip_pattern = re.search(r'ip_address=([\d.]+)', entry)
-        mac_pattern = re.search(r'hw_address=1,([0-9a-fA-F:]+)', entry)
+        # Every field lives on its own `key=value` line, so a single pass over the lines is enough
+        fields = {}
+        for line in entry.splitlines():
+            key, _, value = line.strip().partition('=')
+            fields.setdefault(key, value)
 
+        hw_address = fields.get('hw_address', '')
         return cls(
-            name=name_pattern.group(1) if name_pattern else "Unknown",
-            ip_address=ip_pattern.group(1) if ip_pattern else "Unknown",
-            hw_address=mac_pattern.group(1) if mac_pattern else "Unknown"
+            name=fields.get('name', "Unknown"),
+            ip_address=fields.get('ip_address', "Unknown"),
+            hw_address=hw_address[2:] if hw_address.startswith('1,') else "Unknown"
         )
 
 
@@ -38,7 +43,7 @@ class LeaseList(UserList):
             data = f.read()
 
         # Split entries based on lease block structures `{ ... }`
-        lease_entries = re.findall(r"\{(.*?)\}", data, re.DOTALL)
+        lease_entries = LEASE_BLOCK_PATTERN.findall(data)
 
         # Parse each entry and create LeaseEntry objects
         leases = [LeaseEntry.from_entry(entry.strip()) for entry in lease_entries]
@@ -1,30 +1,44 @@
-import asyncio
 import contextlib
+import copy
 import dataclasses
+import errno
+import fcntl
+import functools
 import logging
+import os
 import plistlib
-import re
+import stat
+import tempfile
+import time
+from ctypes import c_void_p
 from enum import Enum
 from pathlib import Path
-from typing import Generator, Optional
+from typing import TYPE_CHECKING, BinaryIO, Generator, Optional
 
 import click
-import psutil
-from ioregistry.exceptions import IORegistryException
-from ioregistry.ioentry import get_io_services_by_type
-from plumbum import ProcessExecutionError, local
 
 from mac_internet_sharing.dhcpd_leases import LeaseEntry, get_dhcp_leases
 from mac_internet_sharing.exceptions import AccessDeniedError
-from mac_internet_sharing.native_bridge import SCDynamicStoreCreate, SCDynamicStoreNotifyValue
+from mac_internet_sharing.native_bridge import IORegistryEntryHasProperty, IORegistryEntrySearchStringProperty, \
+    SCDynamicStoreCopyNotifiedKeys, SCDynamicStoreCreate, SCDynamicStoreNotifyValue, \
+    SCDynamicStoreSetNotificationKeys, get_bridge_members, get_interface_addresses
 from mac_internet_sharing.network_preference import NetworkService
+from mac_internet_sharing.plist_cache import load_plist_file, update_plist_cache
+
+if TYPE_CHECKING:
+    from ioregistry.ioentry import IOEntry
 
 NAT_CONFIGS = Path('/Library/Preferences/SystemConfiguration/com.apple.nat.plist')
-IFCONFIG = local['ifconfig']
+NAT_COMMIT_KEY = f'Prefs:commit:{NAT_CONFIGS}'.encode()
+BRIDGE_INTERFACE = 'bridge100'
+BRIDGE_STATE_KEY = f'State:/Network/Interface/{BRIDGE_INTERFACE}/IPv4'.encode()
 IDEVICES = ['iPhone', 'iPad']
 
 SLEEP_TIME = 1
+POLL_INTERVAL = 0.01
 PREFIX_SIZE = 3
+MIN_PARALLEL_PROBES = 4
+MAX_PROBE_WORKERS = 8
 
 logger = logging.getLogger(__name__)
 
@@ -42,54 +56,108 @@ class USBEthernetInterface:
     name: str
 
 
-def safe_plist_operation(file_path: Path, mode: str, operation):
-    """Open a file in the given mode, perform an operation, and handle permission errors."""
+def write_plist(file_path: Path, data: dict) -> int:
+    """Atomically replace a plist file, so configd never reads a partially written one. Return the new `st_mtime_ns`."""
+    mode = stat.S_IMODE(file_path.stat().st_mode) if file_path.exists() else 0o644
     try:
-        with file_path.open(mode) as fp:
-            return operation(fp)
+        fp = tempfile.NamedTemporaryFile(dir=file_path.parent, prefix=f'.{file_path.name}.', suffix='.tmp',
+                                         delete=False)
+        try:
+            with fp:
+                plistlib.dump(data, fp)
+                fp.flush()
+                os.fchmod(fp.fileno(), mode)
+                # Taken from the written file itself, the path may already be replaced again by another editor
+                mtime = os.fstat(fp.fileno()).st_mtime_ns
+            os.replace(fp.name, file_path)
+        except BaseException:
+            os.unlink(fp.name)
+            raise
     except PermissionError:
         raise AccessDeniedError()
+    return mtime
+
+
+def open_locked(file_path: Path) -> Optional[BinaryIO]:
+    """Open a file holding an exclusive lock on it, return None if it doesn't exist."""
+    while True:
+        try:
+            fp = file_path.open('rb')
+        except FileNotFoundError:
+            return None
+        except PermissionError:
+            raise AccessDeniedError()
+        fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
+        try:
+            if os.fstat(fp.fileno()).st_ino == file_path.stat().st_ino:
+                return fp
+        except FileNotFoundError:
+            pass
+        # The file was replaced by another editor while waiting for the lock, lock the new one instead
+        fp.close()
 
 
 @contextlib.contextmanager
 def plist_editor(file_path: Path) -> Generator:
-    """Context manager to edit a plist file."""
-    if file_path.exists():
-        data = safe_plist_operation(file_path, 'rb', plistlib.load)
-    else:
-        data = {}
-    yield data
-    safe_plist_operation(file_path, 'wb', lambda fp: plistlib.dump(data, fp))
+    """Context manager to edit a plist file, concurrent editors are serialized by a lock on the file."""
+    fp = open_locked(file_path)
+    with fp if fp is not None else contextlib.nullcontext():
+        original = load_plist_file(file_path, fp) if fp is not None else {}
+        data = copy.deepcopy(original)
+        yield data
+        if data != original:
+            update_plist_cache(file_path, write_plist(file_path, data), data)
 
 
-def get_apple_usb_ethernet_interfaces() -> dict[str, str]:
-    """ Return list of Apple USB Ethernet interfaces. """
-    interfaces = {}
-    for ethernet_interface_entry in get_io_services_by_type('IOEthernetInterface'):
-        try:
-            apple_usb_ncm_data = ethernet_interface_entry.get_parent_by_type('IOService', 'AppleUSBNCMData')
-        except IORegistryException:
-            continue
+def _io_registry_entry(entry: 'IOEntry') -> int:
+    """ Return the raw `io_registry_entry_t` of an IOEntry. """
+    # ioregistry doesn't expose the handle publicly, `_entry` is relied upon as of the version pinned in requirements.txt
+    return entry._entry
 
-        if 'waitBsdStart' in apple_usb_ncm_data.properties:
-            # RSD interface
-            continue
 
-        try:
-            usb_host = ethernet_interface_entry.get_parent_by_type('IOService', 'IOUSBHostDevice')
-        except IORegistryException:
-            continue
+def _probe_idevice_interface(ethernet_interface_entry: 'IOEntry') -> Optional[tuple[str, str]]:
+    """ Return the (udid, interface name) of an iDevice ethernet interface, None for RSD interfaces. """
+    from ioregistry.exceptions import IORegistryException
+
+    try:
+        apple_usb_ncm_data = ethernet_interface_entry.get_parent_by_type('IOService', 'AppleUSBNCMData')
+    except IORegistryException:
+        return None
+
+    if IORegistryEntryHasProperty(_io_registry_entry(apple_usb_ncm_data), b'waitBsdStart'):
+        # RSD interface
+        return None
+
+    usb_serial_number = IORegistryEntrySearchStringProperty(_io_registry_entry(ethernet_interface_entry), b'USB Serial Number')
+    if usb_serial_number is None:
+        return None
+    return usb_serial_number, ethernet_interface_entry.name
+
 
-        product_name = usb_host.properties['USB Product Name']
-        usb_serial_number = usb_host.properties['USB Serial Number']
-        if product_name not in IDEVICES:
-            continue
-        interfaces[usb_serial_number] = ethernet_interface_entry.name
-    return interfaces
+@functools.lru_cache(maxsize=1)
+def get_apple_usb_ethernet_interfaces() -> dict[str, str]:
+    """ Return list of Apple USB Ethernet interfaces (cached, use `cache_clear()` to rescan). """
+    # Imported here since loading IOKit and the thread pool isn't needed by on/off/toggle
+    from concurrent.futures import ThreadPoolExecutor
+
+    from ioregistry.ioentry import get_io_services_by_type
+
+    # Most ethernet interfaces aren't iDevices, filter them out before walking up to `AppleUSBNCMData`
+    candidates = [entry for entry in get_io_services_by_type('IOEthernetInterface')
+                  if IORegistryEntrySearchStringProperty(_io_registry_entry(entry), b'USB Product Name') in IDEVICES]
+    if len(candidates) >= MIN_PARALLEL_PROBES:
+        # Starting the pool costs more than a few serial probes, only worth it with many connected devices
+        with ThreadPoolExecutor(max_workers=min(MAX_PROBE_WORKERS, len(candidates))) as executor:
+            results = list(executor.map(_probe_idevice_interface, candidates))
+    else:
+        results = [_probe_idevice_interface(entry) for entry in candidates]
+    return dict(result for result in results if result is not None)
 
 
 def get_mac_address(interface: str) -> Optional[str]:
     """ Returns the MAC address of the specified network interface. """
+    import psutil
+
     addrs = psutil.net_if_addrs()
 
     if interface in addrs:
@@ -98,10 +166,29 @@ def get_mac_address(interface: str) -> Optional[str]:
                 return addr.address
 
 
-def notify_store() -> None:
-    """Notify system configuration store."""
-    store = SCDynamicStoreCreate(b'MyStore')
-    SCDynamicStoreNotifyValue(store, f'Prefs:commit:{NAT_CONFIGS}'.encode())
+@functools.lru_cache(maxsize=1)
+def get_dynamic_store() -> c_void_p:
+    """ Return a SCDynamicStore session, created once per process. """
+    return SCDynamicStoreCreate(b'MyStore')
+
+
+def notify_store(timeout: float = SLEEP_TIME) -> None:
+    """Notify system configuration store and wait up to `timeout` seconds for the bridge to change."""
+    store = get_dynamic_store()
+    if not timeout:
+        SCDynamicStoreNotifyValue(store, NAT_COMMIT_KEY)
+        return
+
+    SCDynamicStoreSetNotificationKeys(store, [BRIDGE_STATE_KEY])
+    # Drop changes that happened before our commit
+    SCDynamicStoreCopyNotifiedKeys(store)
+    SCDynamicStoreNotifyValue(store, NAT_COMMIT_KEY)
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if SCDynamicStoreCopyNotifiedKeys(store):
+            return
+        time.sleep(POLL_INTERVAL)
 
 
 @dataclasses.dataclass(repr=False)
@@ -126,28 +213,19 @@ class Bridge:
         self.members = members
 
     @classmethod
-    def parse_ifconfig(cls, output: str) -> 'Bridge':
-        name_match = re.search(r'^(\S+):', output, re.MULTILINE)
-        name = name_match.group(1) if name_match else 'Unknown'
-
-        # Extract the IPv4 configuration line.
-        ipv4_match = re.search(
-            r'^\s*(inet\s+\S+\s+netmask\s+\S+\s+broadcast\s+\S+)',
-            output,
-            re.MULTILINE
-        )
-        ipv4 = ipv4_match.group(1) if ipv4_match else ""
-
-        # Extract the IPv6 configuration line.
-        ipv6_match = re.search(
-            r'^\s*(inet6\s+\S+\s+prefixlen\s+\d+\s+scopeid\s+\S+)',
-            output,
-            re.MULTILINE
-        )
-        ipv6 = ipv6_match.group(1) if ipv6_match else ""
-
-        # Extract all member interfaces
-        bridge_members = re.findall(r'^\s*member:\s+(\S+)', output, re.MULTILINE)
+    def from_interface(cls, name: str) -> Optional['Bridge']:
+        """ Query the given bridge interface in-process, return None if it doesn't exist. """
+        addresses = get_interface_addresses(name)
+        if addresses is None:
+            return None
+
+        try:
+            bridge_members = get_bridge_members(name)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # The bridge was torn down after its addresses were queried
+                return None
+            raise
         devices = []
 
         dhcp_leases = get_dhcp_leases()
@@ -158,7 +236,7 @@ class Bridge:
             # Apple randomizes MAC addresses for privacy, so we match only the first few bytes
             lease_entry = dhcp_leases.get_first_entry_matching_prefix(PREFIX_SIZE, get_mac_address(interface))
             devices.append(BridgeMember(udid, interface, lease_entry))
-        return cls(name, ipv4, ipv6, devices)
+        return cls(name, addresses.ipv4, addresses.ipv6, devices)
 
     def __repr__(self) -> str:
         members_formatted = '\n\t'.join(repr(member) for member in self.members)
@@ -171,20 +249,17 @@ class Bridge:
 
 def verify_bridge(name: str = 'bridge100') -> None:
     """ Verify network bridge status. """
-    try:
-        result = IFCONFIG(name)
-    except ProcessExecutionError as e:
-        if f'interface {name} does not exist' in str(e):
-            logger.info('Internet sharing OFF')
-        else:
-            raise e
+    bridge = Bridge.from_interface(name)
+    if bridge is None:
+        logger.info('Internet sharing OFF')
     else:
         logger.info('Internet sharing ON')
-        print(Bridge.parse_ifconfig(result))
+        print(bridge)
 
 
-def configure(service_name: NetworkService, members: list[str], network_name: str = "user's MacBook Pro") -> None:
-    """ Configure NAT settings with given parameters. """
+def configure(service_name: NetworkService, members: list[str], network_name: str = "user's MacBook Pro",
+              start: bool = False) -> None:
+    """ Configure NAT settings with given parameters, and apply them right away if `start` is set. """
     with plist_editor(NAT_CONFIGS) as configs:
         configs.update({
             'NAT': {
@@ -207,34 +282,47 @@ def configure(service_name: NetworkService, members: list[str], network_name: st
                 'SharingDevices': members
             }
         })
+    if start:
+        # NAT is written enabled, so only the commit notification is missing to start sharing
+        notify_store()
+        verify_bridge()
 
 
-async def set_sharing_state(state: SharingState) -> None:
-    """ Set sharing state for NAT configuration. """
+def set_sharing_state(state: SharingState, verify: bool = False) -> None:
+    """ Set sharing state for NAT configuration, and wait for the bridge to report it if `verify` is set. """
     with plist_editor(NAT_CONFIGS) as configs:
         if 'NAT' not in configs:
             return
 
+        current_state = configs['NAT'].get('Enabled', 0)
         if state == SharingState.ON:
             new_state = 1
         elif state == SharingState.OFF:
             new_state = 0
         elif state == SharingState.TOGGLE:
-            new_state = int(not configs['NAT']['Enabled'])
+            new_state = int(not current_state)
         else:
             raise ValueError("Invalid NAT sharing state")
 
         configs['NAT']['Enabled'] = new_state
-    notify_store()
-    await asyncio.sleep(SLEEP_TIME)
-    verify_bridge()
+
+    # plist_editor doesn't rewrite an unchanged plist, but the commit is always posted since the plist may hold
+    # changes configd wasn't notified about yet (e.g. `configure` without `--start`).
+    # Whether to wait depends on the actual bridge, not on the plist, for the same reason.
+    timeout = 0
+    if verify and (get_interface_addresses(BRIDGE_INTERFACE) is not None) != bool(new_state):
+        timeout = SLEEP_TIME
+    notify_store(timeout=timeout)
+    if verify:
+        verify_bridge()
+    else:
+        logger.info(f'Internet sharing {"ON" if new_state else "OFF"}')
 
 
-async def update_sharing_devices(devices: set) -> None:
+def update_sharing_devices(devices: set) -> None:
     """ Update the SharingDevices list in the NAT configuration. """
     with plist_editor(NAT_CONFIGS) as configs:
         if 'NAT' not in configs:
             raise ValueError('NAT configuration not found in the plist.')
         configs['NAT']['SharingDevices'] = list(devices)
     notify_store()
-    await asyncio.sleep(SLEEP_TIME)
@@ -1,9 +1,18 @@
 import ctypes
+import dataclasses
+import fcntl
+import functools
+import os
+import socket
 from ctypes import c_char_p, c_void_p
 from ctypes.util import find_library
+from typing import Optional
 
 kCFStringEncodingUTF8 = 0x08000100
 
+kIORegistryIterateRecursively = 0x00000001
+kIORegistryIterateParents = 0x00000002
+
 # Load shared libraries
 _cf = ctypes.CDLL(find_library('CoreFoundation'))
 _sc = ctypes.CDLL(find_library('SystemConfiguration'))
@@ -11,12 +20,43 @@ _sc = ctypes.CDLL(find_library('SystemConfiguration'))
 _cf.CFStringCreateWithCString.argtypes = [c_void_p, c_char_p, ctypes.c_uint32]
 _cf.CFStringCreateWithCString.restype = c_void_p
 
+_cf.CFStringGetCString.argtypes = [c_void_p, c_char_p, ctypes.c_long, ctypes.c_uint32]
+_cf.CFStringGetCString.restype = ctypes.c_bool
+
+_cf.CFGetTypeID.argtypes = [c_void_p]
+_cf.CFGetTypeID.restype = ctypes.c_ulong
+
+_cf.CFStringGetTypeID.argtypes = []
+_cf.CFStringGetTypeID.restype = ctypes.c_ulong
+
+_cf.CFRelease.argtypes = [c_void_p]
+_cf.CFRelease.restype = None
+
+_cf.CFArrayCreate.argtypes = [c_void_p, ctypes.POINTER(c_void_p), ctypes.c_long, c_void_p]
+_cf.CFArrayCreate.restype = c_void_p
+
+_cf.CFArrayGetCount.argtypes = [c_void_p]
+_cf.CFArrayGetCount.restype = ctypes.c_long
+
+_cf.CFArrayGetValueAtIndex.argtypes = [c_void_p, ctypes.c_long]
+_cf.CFArrayGetValueAtIndex.restype = c_void_p
+
+kCFTypeArrayCallBacks = c_void_p.in_dll(_cf, 'kCFTypeArrayCallBacks')
+
 
 def CFStringCreateWithCString(string: bytes) -> c_void_p:
     """ Create a Core Foundation string. """
     return _cf.CFStringCreateWithCString(None, string, kCFStringEncodingUTF8)
 
 
+def CFStringGetString(cf_string: c_void_p) -> Optional[str]:
+    """ Convert a Core Foundation string into a python string. """
+    buffer = ctypes.create_string_buffer(1024)
+    if not _cf.CFStringGetCString(cf_string, buffer, len(buffer), kCFStringEncodingUTF8):
+        return None
+    return buffer.value.decode()
+
+
 # Configure SystemConfiguration functions
 _sc.SCDynamicStoreCreate.argtypes = [c_void_p, c_void_p, c_void_p, c_void_p]
 _sc.SCDynamicStoreCreate.restype = c_void_p
@@ -24,6 +64,12 @@ _sc.SCDynamicStoreCreate.restype = c_void_p
 _sc.SCDynamicStoreNotifyValue.argtypes = [c_void_p, c_void_p]
 _sc.SCDynamicStoreNotifyValue.restype = None
 
+_sc.SCDynamicStoreSetNotificationKeys.argtypes = [c_void_p, c_void_p, c_void_p]
+_sc.SCDynamicStoreSetNotificationKeys.restype = ctypes.c_bool
+
+_sc.SCDynamicStoreCopyNotifiedKeys.argtypes = [c_void_p]
+_sc.SCDynamicStoreCopyNotifiedKeys.restype = c_void_p
+
 
 def SCDynamicStoreCreate(store_name: bytes) -> c_void_p:
     """ Create a SCDynamicStore with the given store name. """
@@ -38,3 +84,222 @@ def SCDynamicStoreNotifyValue(store: c_void_p, key: bytes) -> None:
     """ Notify the given key in the SCDynamicStore. """
     cf_key = CFStringCreateWithCString(key)
     _sc.SCDynamicStoreNotifyValue(store, cf_key)
+
+
+def SCDynamicStoreSetNotificationKeys(store: c_void_p, keys: list[bytes]) -> None:
+    """ Watch the given keys in the SCDynamicStore. """
+    cf_keys = (c_void_p * len(keys))(*[CFStringCreateWithCString(key) for key in keys])
+    cf_array = _cf.CFArrayCreate(None, cf_keys, len(keys), ctypes.byref(kCFTypeArrayCallBacks))
+    for cf_key in cf_keys:
+        _cf.CFRelease(cf_key)
+    try:
+        if not _sc.SCDynamicStoreSetNotificationKeys(store, cf_array, None):
+            raise RuntimeError('Failed to set SCDynamicStore notification keys')
+    finally:
+        _cf.CFRelease(cf_array)
+
+
+def SCDynamicStoreCopyNotifiedKeys(store: c_void_p) -> list[str]:
+    """ Return the watched keys that changed since the last call. """
+    cf_array = _sc.SCDynamicStoreCopyNotifiedKeys(store)
+    if not cf_array:
+        return []
+    try:
+        return [CFStringGetString(_cf.CFArrayGetValueAtIndex(cf_array, i)) for i in range(_cf.CFArrayGetCount(cf_array))]
+    finally:
+        _cf.CFRelease(cf_array)
+
+
+@functools.lru_cache(maxsize=1)
+def _load_iokit() -> ctypes.CDLL:
+    """ Load and configure IOKit on first use, since on/off/toggle never need it. """
+    iokit = ctypes.CDLL(find_library('IOKit'))
+
+    iokit.IORegistryEntrySearchCFProperty.argtypes = [ctypes.c_uint, c_char_p, c_void_p, c_void_p, ctypes.c_uint32]
+    iokit.IORegistryEntrySearchCFProperty.restype = c_void_p
+
+    iokit.IORegistryEntryCreateCFProperty.argtypes = [ctypes.c_uint, c_void_p, c_void_p, ctypes.c_uint32]
+    iokit.IORegistryEntryCreateCFProperty.restype = c_void_p
+    return iokit
+
+
+def IORegistryEntryHasProperty(entry: int, key: bytes) -> bool:
+    """ Check whether the entry has the given property, without converting all of its properties. """
+    cf_key = CFStringCreateWithCString(key)
+    value = _load_iokit().IORegistryEntryCreateCFProperty(entry, cf_key, None, 0)
+    _cf.CFRelease(cf_key)
+    if not value:
+        return False
+    _cf.CFRelease(value)
+    return True
+
+
+def IORegistryEntrySearchStringProperty(entry: int, key: bytes) -> Optional[str]:
+    """ Search the entry and its parents in the IOService plane for a string property. """
+    cf_key = CFStringCreateWithCString(key)
+    value = _load_iokit().IORegistryEntrySearchCFProperty(entry, b'IOService', cf_key, None,
+                                                          kIORegistryIterateRecursively | kIORegistryIterateParents)
+    _cf.CFRelease(cf_key)
+    if not value:
+        return None
+    try:
+        if _cf.CFGetTypeID(value) != _cf.CFStringGetTypeID():
+            return None
+        return CFStringGetString(value)
+    finally:
+        _cf.CFRelease(value)
+
+
+# Interface addresses and bridge membership (replaces parsing `ifconfig` output)
+IFNAMSIZ = 16
+IFF_BROADCAST = 0x2
+BRDGGIFS = 6  # <net/if_bridgevar.h>: get member interfaces
+
+
+class sockaddr(ctypes.Structure):
+    _fields_ = [('sa_len', ctypes.c_uint8), ('sa_family', ctypes.c_uint8), ('sa_data', ctypes.c_char * 14)]
+
+
+class sockaddr_in(ctypes.Structure):
+    _fields_ = [('sin_len', ctypes.c_uint8), ('sin_family', ctypes.c_uint8), ('sin_port', ctypes.c_uint16),
+                ('sin_addr', ctypes.c_uint8 * 4), ('sin_zero', ctypes.c_char * 8)]
+
+
+class sockaddr_in6(ctypes.Structure):
+    _fields_ = [('sin6_len', ctypes.c_uint8), ('sin6_family', ctypes.c_uint8), ('sin6_port', ctypes.c_uint16),
+                ('sin6_flowinfo', ctypes.c_uint32), ('sin6_addr', ctypes.c_uint8 * 16),
+                ('sin6_scope_id', ctypes.c_uint32)]
+
+
+class ifaddrs(ctypes.Structure):
+    pass
+
+
+ifaddrs._fields_ = [('ifa_next', ctypes.POINTER(ifaddrs)), ('ifa_name', c_char_p), ('ifa_flags', ctypes.c_uint),
+                    ('ifa_addr', ctypes.POINTER(sockaddr)), ('ifa_netmask', ctypes.POINTER(sockaddr)),
+                    ('ifa_dstaddr', ctypes.POINTER(sockaddr)), ('ifa_data', c_void_p)]
+
+
+class ifbreq(ctypes.Structure):
+    _pack_ = 4
+    _fields_ = [('ifbr_ifsname', ctypes.c_char * IFNAMSIZ), ('ifbr_ifsflags', ctypes.c_uint32),
+                ('ifbr_stpflags', ctypes.c_uint32), ('ifbr_path_cost', ctypes.c_uint32),
+                ('ifbr_portno', ctypes.c_uint8), ('ifbr_priority', ctypes.c_uint8), ('ifbr_proto', ctypes.c_uint8),
+                ('ifbr_role', ctypes.c_uint8), ('ifbr_state', ctypes.c_uint8), ('ifbr_addrcnt', ctypes.c_uint32),
+                ('ifbr_addrmax', ctypes.c_uint32), ('ifbr_addrexceeded', ctypes.c_uint32),
+                ('pad', ctypes.c_uint8 * 32)]
+
+
+class ifbifconf(ctypes.Structure):
+    _pack_ = 4
+    _fields_ = [('ifbic_len', ctypes.c_uint32), ('ifbic_buf', c_void_p)]
+
+
+class ifdrv(ctypes.Structure):
+    _fields_ = [('ifd_name', ctypes.c_char * IFNAMSIZ), ('ifd_cmd', ctypes.c_ulong), ('ifd_len', ctypes.c_size_t),
+                ('ifd_data', c_void_p)]
+
+
+# _IOWR('i', 123, struct ifdrv)
+SIOCGDRVSPEC = 0xC0000000 | ((ctypes.sizeof(ifdrv) & 0x1fff) << 16) | (ord('i') << 8) | 123
+
+_libc = ctypes.CDLL(find_library('c'), use_errno=True)
+
+_libc.getifaddrs.argtypes = [ctypes.POINTER(ctypes.POINTER(ifaddrs))]
+_libc.getifaddrs.restype = ctypes.c_int
+
+_libc.freeifaddrs.argtypes = [ctypes.POINTER(ifaddrs)]
+_libc.freeifaddrs.restype = None
+
+
+@dataclasses.dataclass
+class InterfaceAddresses:
+    ipv4: str = ''
+    ipv6: str = ''
+
+
+def _netmask_bytes(netmask: ctypes.POINTER(sockaddr), offset: int, size: int) -> bytes:
+    """ Read a netmask address, netmask sockaddrs may be truncated to their significant bytes (`sa_len`). """
+    raw = ctypes.string_at(netmask, netmask.contents.sa_len)
+    return raw[offset:offset + size].ljust(size, b'\x00')
+
+
+def _format_ipv4(entry: ifaddrs) -> str:
+    """ Format an AF_INET entry the way `ifconfig` prints it. """
+    address = socket.inet_ntop(socket.AF_INET, bytes(ctypes.cast(entry.ifa_addr, ctypes.POINTER(sockaddr_in))
+                                                     .contents.sin_addr))
+    result = f'inet {address}'
+    if entry.ifa_netmask:
+        netmask = _netmask_bytes(entry.ifa_netmask, sockaddr_in.sin_addr.offset, 4)
+        result += f' netmask 0x{netmask.hex()}'
+    if entry.ifa_flags & IFF_BROADCAST and entry.ifa_dstaddr:
+        broadcast = bytes(ctypes.cast(entry.ifa_dstaddr, ctypes.POINTER(sockaddr_in)).contents.sin_addr)
+        result += f' broadcast {socket.inet_ntop(socket.AF_INET, broadcast)}'
+    return result
+
+
+def _format_ipv6(entry: ifaddrs, name: str) -> str:
+    """ Format an AF_INET6 entry the way `ifconfig` prints it. """
+    sin6 = ctypes.cast(entry.ifa_addr, ctypes.POINTER(sockaddr_in6)).contents
+    raw = bytearray(sin6.sin6_addr)
+    scope_id = sin6.sin6_scope_id
+    is_link_local = raw[0] == 0xfe and (raw[1] & 0xc0) == 0x80
+    if is_link_local and (raw[2] or raw[3]):
+        # The kernel embeds the scope id inside link-local addresses (KAME)
+        scope_id = scope_id or int.from_bytes(raw[2:4], 'big')
+        raw[2:4] = b'\x00\x00'
+    address = socket.inet_ntop(socket.AF_INET6, bytes(raw))
+    if is_link_local:
+        address += f'%{name}'
+    result = f'inet6 {address}'
+    if entry.ifa_netmask:
+        netmask = _netmask_bytes(entry.ifa_netmask, sockaddr_in6.sin6_addr.offset, 16)
+        result += f' prefixlen {sum(bin(byte).count("1") for byte in netmask)}'
+    if scope_id:
+        result += f' scopeid 0x{scope_id:x}'
+    return result
+
+
+def get_interface_addresses(name: str) -> Optional[InterfaceAddresses]:
+    """ Return the first IPv4/IPv6 addresses of the given interface using `getifaddrs()`, or None if it doesn't exist. """
+    ifap = ctypes.POINTER(ifaddrs)()
+    if _libc.getifaddrs(ctypes.byref(ifap)) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+
+    result = None
+    try:
+        entry_ptr = ifap
+        while entry_ptr:
+            entry = entry_ptr.contents
+            entry_ptr = entry.ifa_next
+            if entry.ifa_name.decode() != name:
+                continue
+            if result is None:
+                result = InterfaceAddresses()
+            if not entry.ifa_addr:
+                continue
+            family = entry.ifa_addr.contents.sa_family
+            if family == socket.AF_INET and not result.ipv4:
+                result.ipv4 = _format_ipv4(entry)
+            elif family == socket.AF_INET6 and not result.ipv6:
+                result.ipv6 = _format_ipv6(entry, name)
+    finally:
+        _libc.freeifaddrs(ifap)
+    return result
+
+
+def get_bridge_members(name: str) -> list[str]:
+    """ Return the member interface names of the given bridge using the `BRDGGIFS` ioctl. """
+    count = 8
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        while True:
+            requests = (ifbreq * count)()
+            bifc = ifbifconf(ctypes.sizeof(requests), ctypes.addressof(requests))
+            drv = ifdrv(name.encode(), BRDGGIFS, ctypes.sizeof(bifc), ctypes.addressof(bifc))
+            fcntl.ioctl(sock.fileno(), SIOCGDRVSPEC, drv)
+            if bifc.ifbic_len < ctypes.sizeof(requests):
+                break
+            # Buffer might have been too small, retry with a bigger one
+            count *= 2
+    return [request.ifbr_ifsname.decode() for request in requests[:bifc.ifbic_len // ctypes.sizeof(ifbreq)]]
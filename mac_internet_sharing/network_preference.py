@@ -1,13 +1,10 @@
+import functools
 import plistlib
 from collections import UserList
 from dataclasses import dataclass
 from pathlib import Path
 from typing import Any, Callable, Optional
 
-from plumbum import local
-
-ROUTE = local['route']
-
 INTERFACE_PREFERENCES = Path('/Library/Preferences/SystemConfiguration/preferences.plist')
 
 
@@ -80,11 +77,16 @@ class NetworkPreferencePlist:
         return self.network_services.get_by_device_name(current_set_device_name)
 
 
+@functools.lru_cache(maxsize=1)
+def get_network_preferences() -> NetworkPreferencePlist:
+    """ Return the system network preferences, parsed once per process. """
+    return NetworkPreferencePlist(INTERFACE_PREFERENCES)
+
+
 def get_network_services_names() -> list[str]:
     """ Return list of network service names. """
     try:
-        names = [services.user_defined_name for services in
-                 NetworkPreferencePlist(INTERFACE_PREFERENCES).network_services]
+        names = [services.user_defined_name for services in get_network_preferences().network_services]
     except KeyError:
         names = []
     return names
@@ -92,7 +94,10 @@ def get_network_services_names() -> list[str]:
 
 def get_default_route_interface_name() -> Optional[str]:
     """ Return default route interface name. """
-    for line in ROUTE('get', 'default').splitlines():
+    # Imported here since plumbum is slow to import and only needed for the default route
+    from plumbum import local
+
+    for line in local['route']('get', 'default').splitlines():
         # Extract the interface name from the line, e.g., "interface: en0"
         if 'interface:' not in line:
             continue
@@ -102,5 +107,4 @@ def get_default_route_interface_name() -> Optional[str]:
 
 def get_default_route_network_service() -> Optional[NetworkService]:
     """ Return default route network name. """
-    preferences = NetworkPreferencePlist(INTERFACE_PREFERENCES)
-    return preferences.network_services.get_by_device_name(get_default_route_interface_name())
+    return get_network_preferences().network_services.get_by_device_name(get_default_route_interface_name())
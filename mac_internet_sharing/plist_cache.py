@@ -0,0 +1,24 @@
+import os
+import plistlib
+from pathlib import Path
+from typing import Any, BinaryIO
+
+# Parsed plists keyed by path, along with the `st_mtime_ns` they were parsed at
+_PLIST_CACHE: dict[Path, tuple[int, Any]] = {}
+
+
+def load_plist_file(path: Path, fp: BinaryIO) -> Any:
+    """ Load an opened plist file, reusing the previous parse if it wasn't modified since. The result must not be mutated. """
+    mtime = os.fstat(fp.fileno()).st_mtime_ns
+    cached = _PLIST_CACHE.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    data = plistlib.load(fp)
+    _PLIST_CACHE[path] = (mtime, data)
+    return data
+
+
+def update_plist_cache(path: Path, mtime: int, data: Any) -> None:
+    """ Record the data just written to the given plist file, along with the `st_mtime_ns` of what was written. """
+    _PLIST_CACHE[path] = (mtime, data)